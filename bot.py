@@ -1,16 +1,38 @@
 import asyncio
 import os
+import sys
+from collections import OrderedDict
 from datetime import date, timedelta
+from typing import TypeVar
 
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import CallbackQuery, KeyboardButton, Message, ReplyKeyboardMarkup
+from aiogram.types import (
+    CallbackQuery,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    KeyboardButton,
+    Message,
+    ReplyKeyboardMarkup,
+)
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from dotenv import load_dotenv
 
-from db import add_habit, deactivate_habit_for_user, init_db, list_habits, toggle_done_for_user, upsert_user, weekly_status
+from db import (
+    WeekStatus,
+    adb,
+    add_habit,
+    deactivate_and_fetch_week,
+    init_db,
+    list_habits,
+    today_done_set,
+    toggle_and_fetch_week,
+    upsert_user,
+    user_version,
+    weekly_status,
+)
 
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -29,6 +51,30 @@ class HabitCreation(StatesGroup):
 DONE_PREFIX = "done:"
 DELETE_PREFIX = "delete:"
 
+RENDER_CACHE_SIZE = 1024
+# Rendered week tables keyed by (user_id, day ordinal, user_version).
+_WEEK_CACHE: OrderedDict[tuple[int, int, int], str] = OrderedDict()
+# /done keyboards keyed by (user_id, day ordinal, user_version).
+_DONE_KB_CACHE: OrderedDict[tuple[int, int, int], InlineKeyboardMarkup] = OrderedDict()
+# /delete keyboards keyed by (user_id, user_version).
+_DELETE_KB_CACHE: OrderedDict[tuple[int, int], InlineKeyboardMarkup] = OrderedDict()
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+def cache_get(cache: OrderedDict[K, V], key: K) -> V | None:
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+
+def cache_put(cache: OrderedDict[K, V], key: K, value: V) -> None:
+    cache[key] = value
+    if len(cache) > RENDER_CACHE_SIZE:
+        cache.popitem(last=False)
+
 
 def main_menu() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
@@ -45,58 +91,92 @@ def week_dates(today: date) -> list[date]:
     return [monday + timedelta(days=i) for i in range(7)]
 
 
-def build_week_table(habits: list, statuses: dict, days: list[date]) -> str:
-    title_width = 15
-    day_cell_width = 2
-    day_header = "".join(f"{d.strftime('%a')[0]:<{day_cell_width}}" for d in days).rstrip()
-    lines = [
-        f"Week {days[0].strftime('%d %b')} - {days[-1].strftime('%d %b')}",
-        f"{'':{title_width + 1}}{day_header}",
-    ]
+RED = "🟥"
+GREEN = "🟩"
+GLYPHS = (RED, GREEN)
+TITLE_WIDTH = 15
+DAY_CELL_WIDTH = 2
+
+# (day ordinal, week days, "Week ..." title line, day-letter header line) for the current day.
+_DAY_CACHE: tuple[int, list[date], str, str] | None = None
 
-    for h in habits:
-        habit_id = int(h["id"])
-        title = str(h["title"])
-        cells = []
-        for d in days:
-            key = (habit_id, d.isoformat())
-            cells.append("🟩" if statuses.get(key, 0) == 1 else "🟥")
-        lines.append(f"{title[:title_width]:{title_width}} {''.join(cells)}")
+
+def week_context(today: date) -> tuple[list[date], str, str]:
+    global _DAY_CACHE
+    ordinal = today.toordinal()
+    if _DAY_CACHE is None or _DAY_CACHE[0] != ordinal:
+        days = week_dates(today)
+        week_title = f"Week {days[0].strftime('%d %b')} - {days[-1].strftime('%d %b')}"
+        day_letters = "".join(f"{d.strftime('%a')[0]:<{DAY_CELL_WIDTH}}" for d in days).rstrip()
+        _DAY_CACHE = (ordinal, days, week_title, f"{'':{TITLE_WIDTH + 1}}{day_letters}")
+    return _DAY_CACHE[1], _DAY_CACHE[2], _DAY_CACHE[3]
+
+
+def build_week_table(habits: list, statuses: WeekStatus, week_title: str, day_header: str) -> str:
+    lines = [week_title, day_header]
+
+    matrix, habit_index = statuses
+    for habit_id, title in habits:
+        row = matrix[habit_index[habit_id]]
+        cells = "".join(GLYPHS[done] for done in row)
+        lines.append(f"{title[:TITLE_WIDTH]:{TITLE_WIDTH}} {cells}")
 
     return "\n".join(lines)
 
 
-async def send_week_view(message: Message, user_id: int) -> None:
-    habits = list_habits(user_id)
+async def answer_week_view(
+    message: Message, habits: list, statuses: WeekStatus, today: date, status: str = ""
+) -> None:
+    prefix = f"{status}\n" if status else ""
     if not habits:
-        await message.answer("No habits yet. Use /add first.")
+        await message.answer(f"{prefix}No habits yet. Use /add first.")
         return
 
-    days = week_dates(date.today())
-    statuses = weekly_status([int(h["id"]) for h in habits], days)
-    table = build_week_table(habits, statuses, days)
-    await message.answer(f"<pre>{table}</pre>", parse_mode="HTML")
+    _, week_title, day_header = week_context(today)
+    table = build_week_table(habits, statuses, week_title, day_header)
+    await message.answer("".join((prefix, "<pre>", table, "</pre>")), parse_mode="HTML")
 
 
-def build_done_keyboard(habits: list) -> InlineKeyboardBuilder:
-    today = date.today()
-    today_iso = today.isoformat()
-    statuses = weekly_status([int(h["id"]) for h in habits], [today])
+async def send_week_view(message: Message, user_id: int, today: date) -> None:
+    key = (user_id, today.toordinal(), user_version(user_id))
+    table = cache_get(_WEEK_CACHE, key)
+    if table is None:
+        habits = await adb(list_habits, user_id)
+        if not habits:
+            await message.answer("No habits yet. Use /add first.")
+            return
+
+        days, week_title, day_header = week_context(today)
+        statuses = await adb(weekly_status, [habit_id for habit_id, _ in habits], days)
+        table = build_week_table(habits, statuses, week_title, day_header)
+        cache_put(_WEEK_CACHE, key, table)
 
-    kb = InlineKeyboardBuilder()
-    for h in habits:
-        habit_id = int(h["id"])
-        title = str(h["title"])
-        is_done = statuses.get((habit_id, today_iso), 0) == 1
-        marker = "✅" if is_done else "⬜"
-        kb.button(text=f"{marker} {title}", callback_data=f"{DONE_PREFIX}{habit_id}")
-    kb.adjust(1)
-    return kb
+    await message.answer("".join(("<pre>", table, "</pre>")), parse_mode="HTML")
+
+
+async def build_done_keyboard(user_id: int, habits: list, today: date) -> InlineKeyboardMarkup:
+    done_set = await adb(today_done_set, user_id, today)
+    buttons = [
+        InlineKeyboardButton(
+            text=f"{'✅' if habit_id in done_set else '⬜'} {title}",
+            callback_data=f"{DONE_PREFIX}{habit_id}",
+        )
+        for habit_id, title in habits
+    ]
+    return InlineKeyboardBuilder().row(*buttons, width=1).as_markup()
+
+
+def build_delete_keyboard(habits: list) -> InlineKeyboardMarkup:
+    buttons = [
+        InlineKeyboardButton(text=f"❌ {title}", callback_data=f"{DELETE_PREFIX}{habit_id}")
+        for habit_id, title in habits
+    ]
+    return InlineKeyboardBuilder().row(*buttons, width=1).as_markup()
 
 
 @dp.message(CommandStart())
 async def start(message: Message) -> None:
-    upsert_user(message.from_user.id, message.from_user.username)
+    await adb(upsert_user, message.from_user.id, message.from_user.username)
     text = (
         "Habit tracker bot.\n\n"
         "Commands:\n"
@@ -110,37 +190,42 @@ async def start(message: Message) -> None:
 
 @dp.message(Command("add"))
 async def add_command(message: Message, state: FSMContext) -> None:
-    upsert_user(message.from_user.id, message.from_user.username)
+    await adb(upsert_user, message.from_user.id, message.from_user.username)
     await state.set_state(HabitCreation.waiting_for_title)
     await message.answer("Send habit name (example: Water 2L)")
 
 
 @dp.message(HabitCreation.waiting_for_title)
 async def handle_habit_title(message: Message, state: FSMContext) -> None:
-    user_id = upsert_user(message.from_user.id, message.from_user.username)
+    user_id = await adb(upsert_user, message.from_user.id, message.from_user.username)
     title = (message.text or "").strip()
 
     if len(title) < 2:
         await message.answer("Habit name is too short. Try again.")
         return
 
-    habit_id = add_habit(user_id, title)
+    habit_id = await adb(add_habit, user_id, title)
     await state.clear()
     await message.answer(f"Added habit #{habit_id}: {title}", reply_markup=main_menu())
-    await send_week_view(message, user_id)
+    await send_week_view(message, user_id, date.today())
 
 
 @dp.message(Command("done"))
 async def done_command(message: Message) -> None:
-    user_id = upsert_user(message.from_user.id, message.from_user.username)
-    habits = list_habits(user_id)
+    user_id = await adb(upsert_user, message.from_user.id, message.from_user.username)
+    today = date.today()
+    key = (user_id, today.toordinal(), user_version(user_id))
+    markup = cache_get(_DONE_KB_CACHE, key)
+    if markup is None:
+        habits = await adb(list_habits, user_id)
+        if not habits:
+            await message.answer("No habits yet. Use /add first.")
+            return
 
-    if not habits:
-        await message.answer("No habits yet. Use /add first.")
-        return
+        markup = await build_done_keyboard(user_id, habits, today)
+        cache_put(_DONE_KB_CACHE, key, markup)
 
-    kb = build_done_keyboard(habits)
-    await message.answer("Toggle done for today (tap again to undo):", reply_markup=kb.as_markup())
+    await message.answer("Toggle done for today (tap again to undo):", reply_markup=markup)
 
 
 @dp.callback_query(F.data.startswith(DONE_PREFIX))
@@ -154,8 +239,10 @@ async def done_callback(callback: CallbackQuery) -> None:
         await callback.answer("Invalid habit", show_alert=True)
         return
 
-    user_id = upsert_user(callback.from_user.id, callback.from_user.username)
-    toggle_result = toggle_done_for_user(user_id, habit_id, date.today())
+    user_id = await adb(upsert_user, callback.from_user.id, callback.from_user.username)
+    today = date.today()
+    days, _, _ = week_context(today)
+    toggle_result, habits, statuses = await adb(toggle_and_fetch_week, user_id, habit_id, today, days)
     if toggle_result is None:
         await callback.answer("Habit not found", show_alert=True)
         return
@@ -163,28 +250,25 @@ async def done_callback(callback: CallbackQuery) -> None:
     callback_text = "Saved" if toggle_result == "marked" else "Removed"
     await callback.answer(callback_text)
     if callback.message:
-        if toggle_result == "marked":
-            await callback.message.answer("Marked done for today ✅")
-        else:
-            await callback.message.answer("Removed done mark for today ↩️")
-        await send_week_view(callback.message, user_id)
+        status = "Marked done for today ✅" if toggle_result == "marked" else "Removed done mark for today ↩️"
+        await answer_week_view(callback.message, habits, statuses, today, status)
 
 
 @dp.message(Command("delete"))
 async def delete_command(message: Message) -> None:
-    user_id = upsert_user(message.from_user.id, message.from_user.username)
-    habits = list_habits(user_id)
+    user_id = await adb(upsert_user, message.from_user.id, message.from_user.username)
+    key = (user_id, user_version(user_id))
+    markup = cache_get(_DELETE_KB_CACHE, key)
+    if markup is None:
+        habits = await adb(list_habits, user_id)
+        if not habits:
+            await message.answer("No habits to delete.")
+            return
 
-    if not habits:
-        await message.answer("No habits to delete.")
-        return
+        markup = build_delete_keyboard(habits)
+        cache_put(_DELETE_KB_CACHE, key, markup)
 
-    kb = InlineKeyboardBuilder()
-    for h in habits:
-        kb.button(text=f"❌ {h['title']}", callback_data=f"{DELETE_PREFIX}{h['id']}")
-    kb.adjust(1)
-
-    await message.answer("Pick a habit to delete:", reply_markup=kb.as_markup())
+    await message.answer("Pick a habit to delete:", reply_markup=markup)
 
 
 @dp.callback_query(F.data.startswith(DELETE_PREFIX))
@@ -198,22 +282,23 @@ async def delete_callback(callback: CallbackQuery) -> None:
         await callback.answer("Invalid habit", show_alert=True)
         return
 
-    user_id = upsert_user(callback.from_user.id, callback.from_user.username)
-    deleted = deactivate_habit_for_user(user_id, habit_id)
+    user_id = await adb(upsert_user, callback.from_user.id, callback.from_user.username)
+    today = date.today()
+    days, _, _ = week_context(today)
+    deleted, habits, statuses = await adb(deactivate_and_fetch_week, user_id, habit_id, days)
     if not deleted:
         await callback.answer("Habit not found", show_alert=True)
         return
 
     await callback.answer("Deleted")
     if callback.message:
-        await callback.message.answer("Habit deleted 🗑️")
-        await send_week_view(callback.message, user_id)
+        await answer_week_view(callback.message, habits, statuses, today, "Habit deleted 🗑️")
 
 
 @dp.message(Command("week"))
 async def week_command(message: Message) -> None:
-    user_id = upsert_user(message.from_user.id, message.from_user.username)
-    await send_week_view(message, user_id)
+    user_id = await adb(upsert_user, message.from_user.id, message.from_user.username)
+    await send_week_view(message, user_id, date.today())
 
 
 async def main() -> None:
@@ -222,4 +307,9 @@ async def main() -> None:
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if sys.platform == "win32":
+        asyncio.run(main())
+    else:
+        import uvloop
+
+        uvloop.run(main())
@@ -1,19 +1,230 @@
+import asyncio
+import json
+import os
+import queue
 import sqlite3
+import threading
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import date
+from functools import lru_cache
 from pathlib import Path
-from typing import Iterable
+from typing import Iterable, TypeVar
 
 DB_PATH = Path("database.sqlite3")
 
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA mmap_size=134217728",
+    "PRAGMA busy_timeout=30000",
+)
 
-def get_connection() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+STATEMENT_CACHE_SIZE = 256
+
+# One bytes row of done flags per habit (aligned with the requested week days),
+# plus the habit_id -> row lookup.
+WeekStatus = tuple[list[bytes], dict[int, int]]
+
+UPSERT_USER_SQL = """
+    INSERT INTO users (tg_user_id, tg_username)
+    VALUES (?, ?)
+    ON CONFLICT(tg_user_id) DO UPDATE SET tg_username = excluded.tg_username
+    RETURNING id
+"""
+
+INSERT_HABIT_SQL = "INSERT INTO habits (user_id, title) VALUES (?, ?)"
+
+LIST_HABITS_SQL = """
+    SELECT id, title
+    FROM habits
+    WHERE user_id = ? AND is_active = 1
+    ORDER BY id ASC
+"""
+
+DEACTIVATE_HABIT_SQL = """
+    UPDATE habits
+    SET is_active = 0
+    WHERE id = ? AND user_id = ? AND is_active = 1
+"""
+
+MARK_DONE_SQL = """
+    INSERT INTO habit_logs (habit_id, log_date, done)
+    VALUES (?, ?, 1)
+    ON CONFLICT(habit_id, log_date) DO UPDATE SET done = 1
+"""
+
+MARK_DONE_FOR_USER_SQL = """
+    INSERT INTO habit_logs (habit_id, log_date, done)
+    SELECT h.id, ?, 1
+    FROM habits h
+    WHERE h.id = ? AND h.user_id = ? AND h.is_active = 1
+    ON CONFLICT(habit_id, log_date) DO UPDATE SET done = 1
+"""
+
+TOGGLE_DONE_SQL = """
+    INSERT INTO habit_logs (habit_id, log_date, done)
+    SELECT h.id, ?, 1
+    FROM habits h
+    WHERE h.id = ? AND h.user_id = ? AND h.is_active = 1
+    ON CONFLICT(habit_id, log_date) DO UPDATE SET done = 1 - done
+    RETURNING done
+"""
+
+TODAY_DONE_SQL = """
+    SELECT l.habit_id
+    FROM habit_logs l
+    JOIN habits h ON h.id = l.habit_id
+    WHERE h.user_id = ? AND l.log_date = ? AND l.done = 1
+"""
+
+WEEKLY_STATUS_SQL = """
+    SELECT habit_id, {day_columns}
+    FROM habit_logs
+    WHERE habit_id IN (SELECT value FROM json_each(?))
+      AND log_date BETWEEN ? AND ?
+    GROUP BY habit_id
+"""
+
+WEEKLY_STATUS_DAY_COLUMN = "MAX(CASE WHEN log_date = ? THEN done ELSE 0 END)"
+
+
+def apply_pragmas(conn: sqlite3.Connection) -> None:
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+
+
+class ConnectionPool:
+    def __init__(self, path: Path, read_size: int) -> None:
+        self.path = path
+        self._writer: sqlite3.Connection | None = None
+        self._write_lock = threading.Lock()
+        self._readers: queue.Queue[sqlite3.Connection | None] = queue.Queue()
+        for _ in range(read_size):
+            self._readers.put(None)
+
+    def _connect(self, read_only: bool) -> sqlite3.Connection:
+        if read_only:
+            target = f"{self.path.resolve().as_uri()}?mode=ro"
+            conn = sqlite3.connect(
+                target,
+                uri=True,
+                check_same_thread=False,
+                isolation_level=None,
+                cached_statements=STATEMENT_CACHE_SIZE,
+            )
+        else:
+            conn = sqlite3.connect(
+                self.path,
+                check_same_thread=False,
+                isolation_level=None,
+                cached_statements=STATEMENT_CACHE_SIZE,
+            )
+        apply_pragmas(conn)
+        return conn
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        conn = self._readers.get()
+        try:
+            if conn is None:
+                conn = self._connect(read_only=True)
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect(read_only=False)
+            yield self._writer
+
+
+_pool: ConnectionPool | None = None
+_pool_lock = threading.Lock()
+_executor: ThreadPoolExecutor | None = None
+
+T = TypeVar("T")
+
+
+def read_pool_size() -> int:
+    return int(os.getenv("DB_READ_POOL_SIZE", "4"))
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_PATH, read_pool_size())
+    return _pool
+
+
+async def adb(fn: Callable[..., T], *args: object) -> T:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=read_pool_size(), thread_name_prefix="db")
+    return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+
+
+# Per-user write counter. Bumped after each committed change to a user's habits
+# or logs so callers can key caches on it.
+_user_versions: dict[int, int] = {}
+
+
+def user_version(user_id: int) -> int:
+    return _user_versions.get(user_id, 0)
+
+
+def _bump_user_version(user_id: int) -> None:
+    # Only called while holding the writer connection, so writers never race here.
+    _user_versions[user_id] = _user_versions.get(user_id, 0) + 1
+
+
+# Habit ids each user has marked done on _today_ordinal. Filled lazily by
+# today_done_set, kept current by the toggle write path and dropped when the day changes.
+_today_done: dict[int, set[int]] = {}
+_today_ordinal = 0
+_today_lock = threading.Lock()
+
+
+def _roll_today(ordinal: int) -> None:
+    # Caller holds _today_lock.
+    global _today_ordinal
+    if ordinal > _today_ordinal:
+        _today_done.clear()
+        _today_ordinal = ordinal
+
+
+def _record_done(user_id: int, habit_id: int, target_date: date, done: bool) -> None:
+    with _today_lock:
+        _roll_today(target_date.toordinal())
+        done_set = _today_done.get(user_id)
+        if done_set is None or target_date.toordinal() != _today_ordinal:
+            return
+        if done:
+            done_set.add(habit_id)
+        else:
+            done_set.discard(habit_id)
+
+
+@contextmanager
+def with_transaction(conn: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
 
 
 def init_db() -> None:
-    with get_connection() as conn:
+    with get_pool().writer() as conn, with_transaction(conn):
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS users (
@@ -49,148 +260,159 @@ def init_db() -> None:
             )
             """
         )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_habits_user_active ON habits(user_id, is_active)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_habit_date ON habit_logs(habit_id, log_date)")
+    with get_pool().writer() as conn:
+        conn.execute("ANALYZE")
 
 
+@lru_cache(maxsize=10000)
 def upsert_user(tg_user_id: int, tg_username: str | None) -> int:
-    with get_connection() as conn:
-        conn.execute(
-            """
-            INSERT INTO users (tg_user_id, tg_username)
-            VALUES (?, ?)
-            ON CONFLICT(tg_user_id) DO UPDATE SET tg_username = excluded.tg_username
-            """,
-            (tg_user_id, tg_username),
-        )
-        row = conn.execute("SELECT id FROM users WHERE tg_user_id = ?", (tg_user_id,)).fetchone()
-        return int(row["id"])
+    with get_pool().writer() as conn, with_transaction(conn):
+        row = conn.execute(UPSERT_USER_SQL, (tg_user_id, tg_username)).fetchone()
+    return row[0]
 
 
 def add_habit(user_id: int, title: str) -> int:
-    with get_connection() as conn:
-        cursor = conn.execute(
-            "INSERT INTO habits (user_id, title) VALUES (?, ?)",
-            (user_id, title.strip()),
-        )
-        return int(cursor.lastrowid)
+    with get_pool().writer() as conn:
+        with with_transaction(conn):
+            cursor = conn.execute(INSERT_HABIT_SQL, (user_id, title.strip()))
+        _bump_user_version(user_id)
+    return int(cursor.lastrowid)
 
 
-def list_habits(user_id: int) -> list[sqlite3.Row]:
-    with get_connection() as conn:
-        rows = conn.execute(
-            """
-            SELECT id, title
-            FROM habits
-            WHERE user_id = ? AND is_active = 1
-            ORDER BY id ASC
-            """,
-            (user_id,),
-        ).fetchall()
-        return list(rows)
+def _list_habits(conn: sqlite3.Connection, user_id: int) -> list[tuple[int, str]]:
+    return conn.execute(LIST_HABITS_SQL, (user_id,)).fetchall()
+
+
+def list_habits(user_id: int) -> list[tuple[int, str]]:
+    with get_pool().reader() as conn:
+        return _list_habits(conn, user_id)
+
+
+def _deactivate_habit(conn: sqlite3.Connection, user_id: int, habit_id: int) -> bool:
+    cursor = conn.execute(DEACTIVATE_HABIT_SQL, (habit_id, user_id))
+    return cursor.rowcount > 0
 
 
 def deactivate_habit_for_user(user_id: int, habit_id: int) -> bool:
-    with get_connection() as conn:
-        cursor = conn.execute(
-            """
-            UPDATE habits
-            SET is_active = 0
-            WHERE id = ? AND user_id = ? AND is_active = 1
-            """,
-            (habit_id, user_id),
-        )
-        return cursor.rowcount > 0
+    with get_pool().writer() as conn:
+        with with_transaction(conn):
+            deleted = _deactivate_habit(conn, user_id, habit_id)
+        if deleted:
+            _bump_user_version(user_id)
+    return deleted
 
 
 def mark_done(habit_id: int, target_date: date) -> bool:
-    with get_connection() as conn:
-        cursor = conn.execute(
-            """
-            INSERT INTO habit_logs (habit_id, log_date, done)
-            VALUES (?, ?, 1)
-            ON CONFLICT(habit_id, log_date) DO UPDATE SET done = 1
-            """,
-            (habit_id, target_date.isoformat()),
-        )
-        return cursor.rowcount > 0
+    with get_pool().writer() as conn, with_transaction(conn):
+        cursor = conn.execute(MARK_DONE_SQL, (habit_id, target_date.isoformat()))
+    return cursor.rowcount > 0
 
 
 def mark_done_for_user(user_id: int, habit_id: int, target_date: date) -> bool:
-    with get_connection() as conn:
-        cursor = conn.execute(
-            """
-            INSERT INTO habit_logs (habit_id, log_date, done)
-            SELECT h.id, ?, 1
-            FROM habits h
-            WHERE h.id = ? AND h.user_id = ? AND h.is_active = 1
-            ON CONFLICT(habit_id, log_date) DO UPDATE SET done = 1
-            """,
-            (target_date.isoformat(), habit_id, user_id),
-        )
-        return cursor.rowcount > 0
+    with get_pool().writer() as conn:
+        with with_transaction(conn):
+            cursor = conn.execute(MARK_DONE_FOR_USER_SQL, (target_date.isoformat(), habit_id, user_id))
+        if cursor.rowcount > 0:
+            _bump_user_version(user_id)
+            _record_done(user_id, habit_id, target_date, True)
+    return cursor.rowcount > 0
+
+
+def _toggle_done(conn: sqlite3.Connection, user_id: int, habit_id: int, target_date: date) -> str | None:
+    row = conn.execute(TOGGLE_DONE_SQL, (target_date.isoformat(), habit_id, user_id)).fetchone()
+    if row is None:
+        return None
+    return "marked" if row[0] == 1 else "unmarked"
 
 
 def toggle_done_for_user(user_id: int, habit_id: int, target_date: date) -> str | None:
-    with get_connection() as conn:
-        owner_row = conn.execute(
-            """
-            SELECT id
-            FROM habits
-            WHERE id = ? AND user_id = ? AND is_active = 1
-            """,
-            (habit_id, user_id),
-        ).fetchone()
-        if owner_row is None:
-            return None
-
-        log_date = target_date.isoformat()
-        existing_row = conn.execute(
-            """
-            SELECT 1
-            FROM habit_logs
-            WHERE habit_id = ? AND log_date = ? AND done = 1
-            """,
-            (habit_id, log_date),
-        ).fetchone()
-
-        if existing_row:
-            conn.execute(
-                """
-                DELETE FROM habit_logs
-                WHERE habit_id = ? AND log_date = ?
-                """,
-                (habit_id, log_date),
-            )
-            return "unmarked"
+    with get_pool().writer() as conn:
+        with with_transaction(conn):
+            result = _toggle_done(conn, user_id, habit_id, target_date)
+        if result is not None:
+            _bump_user_version(user_id)
+            _record_done(user_id, habit_id, target_date, result == "marked")
+    return result
 
-        conn.execute(
-            """
-            INSERT INTO habit_logs (habit_id, log_date, done)
-            VALUES (?, ?, 1)
-            ON CONFLICT(habit_id, log_date) DO UPDATE SET done = 1
-            """,
-            (habit_id, log_date),
-        )
-        return "marked"
+
+@lru_cache(maxsize=8)
+def _weekly_status_sql(day_count: int) -> str:
+    return WEEKLY_STATUS_SQL.format(day_columns=", ".join([WEEKLY_STATUS_DAY_COLUMN] * day_count))
 
 
-def weekly_status(habit_ids: Iterable[int], week_dates: list[date]) -> dict[tuple[int, str], int]:
+def _weekly_status(conn: sqlite3.Connection, habit_ids: Iterable[int], week_dates: list[date]) -> WeekStatus:
     habit_id_list = list(habit_ids)
     if not habit_id_list:
-        return {}
-
-    placeholders = ",".join(["?"] * len(habit_id_list))
-    params = habit_id_list
-    params.extend([week_dates[0].isoformat(), week_dates[-1].isoformat()])
-
-    with get_connection() as conn:
-        rows = conn.execute(
-            f"""
-            SELECT habit_id, log_date, done
-            FROM habit_logs
-            WHERE habit_id IN ({placeholders})
-              AND log_date BETWEEN ? AND ?
-            """,
-            params,
-        ).fetchall()
-
-    return {(int(r["habit_id"]), str(r["log_date"])): int(r["done"]) for r in rows}
+        return [], {}
+
+    habit_index = {habit_id: i for i, habit_id in enumerate(habit_id_list)}
+    matrix = [bytes(len(week_dates))] * len(habit_id_list)
+
+    day_isos = [d.isoformat() for d in week_dates]
+    sql = _weekly_status_sql(len(day_isos))
+    params = [*day_isos, json.dumps(habit_id_list), day_isos[0], day_isos[-1]]
+    for habit_id, *days in conn.execute(sql, params):
+        matrix[habit_index[habit_id]] = bytes(days)
+
+    return matrix, habit_index
+
+
+def weekly_status(habit_ids: Iterable[int], week_dates: list[date]) -> WeekStatus:
+    with get_pool().reader() as conn:
+        return _weekly_status(conn, habit_ids, week_dates)
+
+
+def today_done_set(user_id: int, target_date: date) -> set[int]:
+    ordinal = target_date.toordinal()
+    with _today_lock:
+        _roll_today(ordinal)
+        cached = _today_done.get(user_id) if ordinal == _today_ordinal else None
+        if cached is not None:
+            return set(cached)
+        version = user_version(user_id)
+
+    with get_pool().reader() as conn:
+        rows = conn.execute(TODAY_DONE_SQL, (user_id, target_date.isoformat()))
+        done_set = {habit_id for (habit_id,) in rows}
+
+    with _today_lock:
+        # Skip caching if a write landed while we were reading; the next call refetches.
+        if ordinal == _today_ordinal and user_version(user_id) == version:
+            _today_done[user_id] = set(done_set)
+    return done_set
+
+
+def _fetch_week(
+    conn: sqlite3.Connection, user_id: int, week_dates: list[date]
+) -> tuple[list[tuple[int, str]], WeekStatus]:
+    habits = _list_habits(conn, user_id)
+    statuses = _weekly_status(conn, [habit_id for habit_id, _ in habits], week_dates)
+    return habits, statuses
+
+
+def toggle_and_fetch_week(
+    user_id: int, habit_id: int, target_date: date, week_dates: list[date]
+) -> tuple[str | None, list[tuple[int, str]], WeekStatus]:
+    with get_pool().writer() as conn:
+        with with_transaction(conn):
+            result = _toggle_done(conn, user_id, habit_id, target_date)
+            if result is None:
+                return None, [], ([], {})
+            habits, statuses = _fetch_week(conn, user_id, week_dates)
+        _bump_user_version(user_id)
+        _record_done(user_id, habit_id, target_date, result == "marked")
+    return result, habits, statuses
+
+
+def deactivate_and_fetch_week(
+    user_id: int, habit_id: int, week_dates: list[date]
+) -> tuple[bool, list[tuple[int, str]], WeekStatus]:
+    with get_pool().writer() as conn:
+        with with_transaction(conn):
+            if not _deactivate_habit(conn, user_id, habit_id):
+                return False, [], ([], {})
+            habits, statuses = _fetch_week(conn, user_id, week_dates)
+        _bump_user_version(user_id)
+    return True, habits, statuses